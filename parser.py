@@ -8,23 +8,25 @@ and converts the highlights and notes into a more readable markdown format.
 """
 
 import argparse
-import json
+import functools
+import io
+import logging
+import mmap
+import operator
 import os
 import re
-import logging
-import dateutil.parser
+import stat
+from collections import defaultdict
 
 # Import local modules
-from utils import BasicEqualityMixin, DatetimeJSONEncoder
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+from utils import (
+    BasicEqualityMixin,
+    parse_date,
+    write_json,
 )
+
 logger = logging.getLogger(__name__)
 
-# E.g. Friday, May 13, 2016 11:23:26 PM
-DATETIME_FORMAT = "%A, %B %d, %Y %I:%M:%S %p"
 CLIPPINGS_SEPARATOR = "=========="
 
 
@@ -34,6 +36,8 @@ class Document(BasicEqualityMixin):
     A document has a title, and one or multiple authors (in a string).
     """
 
+    __slots__ = ("authors", "title")
+
     PATTERN = re.compile(r"^(?P<title>.+) \((?P<authors>.+?)\)$")
 
     def __init__(self, title, authors):
@@ -44,18 +48,28 @@ class Document(BasicEqualityMixin):
         return "{title} ({authors})".format(title=self.title, authors=self.authors)
 
     def to_dict(self):
-        return self.__dict__
+        return {"title": self.title, "authors": self.authors}
 
     @classmethod
     def parse(cls, line):
-        match = re.match(cls.PATTERN, line)
-        if match:
-            title = match.group("title")
-            authors = match.group("authors")
-            return cls(title, authors)
-        else:
-            # If pattern doesn't match, assume entire line is title with unknown authors
-            return cls(line.strip(), "Unknown")
+        return _parse_document(cls, line)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_document(cls, line):
+    """Parse a document line, sharing one instance per distinct line.
+
+    The same title line is repeated for every clipping of a book; documents
+    are never modified after parsing, so handing out the same object is safe.
+    """
+    match = cls.PATTERN.match(line)
+    if match:
+        title = match.group("title")
+        authors = match.group("authors")
+        return cls(title, authors)
+    else:
+        # If pattern doesn't match, assume entire line is title with unknown authors
+        return cls(line.strip(), "Unknown")
 
 
 class Location(BasicEqualityMixin):
@@ -64,6 +78,8 @@ class Location(BasicEqualityMixin):
     A location consists of a begin-end range.
     """
 
+    __slots__ = ("begin", "end")
+
     def __init__(self, begin, end):
         self.begin = begin
         self.end = end
@@ -75,17 +91,13 @@ class Location(BasicEqualityMixin):
             return "{0}-{1}".format(self.begin, self.end)
 
     def to_dict(self):
-        return self.__dict__
+        return {"begin": self.begin, "end": self.end}
 
     @classmethod
     def parse(cls, string):
-        ranges = string.split("-")
-        if len(ranges) == 1:
-            begin = end = ranges[0]
-        else:
-            begin = ranges[0]
-            end = ranges[1]
-        return cls(int(begin), int(end))
+        begin, separator, end = string.partition("-")
+        begin = int(begin)
+        return cls(begin, int(end) if separator else begin)
 
 
 class Metadata(BasicEqualityMixin):
@@ -97,6 +109,8 @@ class Metadata(BasicEqualityMixin):
     - The page within the document (not always present).
     """
 
+    __slots__ = ("category", "location", "page", "timestamp")
+
     PATTERN = re.compile(
         r"^- Your (?P<category>\w+) "
         + r"(on|at) ((P|p)age (?P<page>\d+) \| )?"
@@ -104,8 +118,6 @@ class Metadata(BasicEqualityMixin):
         + r"Added on (?P<timestamp>.+)$"
     )
 
-    HOUR_PATTERN = re.compile(r"0(\d:\d{2}:\d{2})")
-
     def __init__(self, category, location, timestamp, page=None):
         self.category = category
         self.location = location
@@ -115,11 +127,16 @@ class Metadata(BasicEqualityMixin):
     def __str__(self):
         page_string = "" if self.page is None else "page {0} | ".format(self.page)
 
-        # Remove leading zero's from the timestamp.
-        # They are not present in the Kindle format, but can't be avoided
-        # in strftime.
-        timestamp_str = self.timestamp.strftime(DATETIME_FORMAT)
-        timestamp_str = re.sub(self.HOUR_PATTERN, r"\1", timestamp_str)
+        # The time is assembled by hand: Kindle writes the hour without a
+        # leading zero, which can't be avoided with strftime's %I.
+        t = self.timestamp
+        timestamp_str = "{date} {hour}:{minute:02d}:{second:02d} {ampm}".format(
+            date=t.strftime("%A, %B %d, %Y"),
+            hour=t.hour % 12 or 12,
+            minute=t.minute,
+            second=t.second,
+            ampm="AM" if t.hour < 12 else "PM",
+        )
 
         return "- Your {category} on {page}Location {location} | Added on {timestamp}".format(
             category=self.category.title(),
@@ -138,23 +155,39 @@ class Metadata(BasicEqualityMixin):
 
     @classmethod
     def parse(cls, line):
-        match = re.match(cls.PATTERN, line)
+        match = cls.PATTERN.match(line)
         if not match:
             raise ValueError(f"Could not parse metadata line: {line}")
 
-        category = match.group("category")
-        location = Location.parse(match.group("location"))
-        timestamp = dateutil.parser.parse(match.group("timestamp"))
-        try:
-            page = int(match.group("page"))
-        except (TypeError, ValueError):
-            page = None
+        category, page, location, timestamp = match.group(
+            "category", "page", "location", "timestamp"
+        )
+        location = Location.parse(location)
+        timestamp = parse_date(timestamp)
+        # The pattern only lets digits through, so only a missing page is None
+        page = None if page is None else int(page)
         return cls(category, location, timestamp, page)
 
 
 class Clipping(BasicEqualityMixin):
     """Kindle clipping: content associated with a particular document"""
 
+    __slots__ = ("content", "document", "metadata")
+
+    # Whole (stripped) entry in one pass: document line (left to the cached
+    # Document.parse), metadata line, the skipped third line and the remaining
+    # content. Mirrors Metadata.PATTERN; entries it doesn't match are parsed
+    # line by line.
+    PATTERN = re.compile(
+        r"^(?P<document>[^\n]+)\n"
+        + r"- Your (?P<category>\w+) "
+        + r"(?:on|at) (?:[Pp]age (?P<page>\d+) \| )?"
+        + r"[Ll]ocation (?P<location>\d+(?:-\d+)?) \| "
+        + r"Added on (?P<timestamp>[^\n]+)\n"
+        + r"[^\n]*(?:\n(?P<content>.*))?$",
+        re.DOTALL,
+    )
+
     def __init__(self, document, metadata, content):
         self.document = document
         self.metadata = metadata
@@ -171,33 +204,103 @@ class Clipping(BasicEqualityMixin):
         }
 
 
-def parse_clippings(clippings_file):
-    """Take a file containing clippings, and return a list of objects."""
+def _parse_entry(entry):
+    """Parse the text of a single entry into a Clipping.
 
-    # Last separator not followed by an entry
-    entries = clippings_file.read().split(CLIPPINGS_SEPARATOR)[:-1]
-    clippings = []
+    Returns None for entries too short to hold a clipping.
+    """
+    entry = entry.strip()
+    match = Clipping.PATTERN.match(entry)
+    if match:
+        document = Document.parse(match.group("document"))
+        page = match.group("page")
+        metadata = Metadata(
+            match.group("category"),
+            Location.parse(match.group("location")),
+            parse_date(match.group("timestamp")),
+            None if page is None else int(page),
+        )
+        content = (match.group("content") or "").strip()
+        return Clipping(document, metadata, content)
 
-    for entry in entries:
-        lines = entry.strip().splitlines()
-        if len(lines) < 3:
-            continue
+    lines = entry.splitlines()
+    if len(lines) < 3:
+        return None
 
-        try:
-            document_line = lines[0]
-            document = Document.parse(document_line)
+    document = Document.parse(lines[0])
+    metadata = Metadata.parse(lines[1])
+    content = "\n".join(lines[3:]).strip()
+    return Clipping(document, metadata, content)
 
-            metadata_line = lines[1]
-            metadata = Metadata.parse(metadata_line)
 
-            content = "\n".join(lines[3:]).strip()
+def _split_entries(data, separator):
+    """Yield the text before each separator in data (a str, bytes or mmap).
 
-            clippings.append(Clipping(document, metadata, content))
+    Anything after the last separator is not an entry.
+    """
+    start = 0
+    while True:
+        end = data.find(separator, start)
+        if end == -1:
+            return
+        yield data[start:end]
+        start = end + len(separator)
+
+
+def _decode_entry(raw):
+    """Decode raw entry bytes the way a text-mode file read would."""
+    return raw.replace(b"\r\n", b"\n").replace(b"\r", b"\n").decode("utf-8")
+
+
+def _parse_entries(entries):
+    """Parse the text of each entry, skipping (and logging) invalid ones."""
+    for entry in entries:
+        try:
+            clipping = _parse_entry(entry)
         except Exception as e:
-            logger.warning(f"Error parsing clipping: {e}")
+            logger.warning("Error parsing clipping: %s", e)
             continue
+        if clipping is not None:
+            yield clipping
+
 
-    return clippings
+def parse_clippings(clippings_file):
+    """Take a file containing clippings, and return an iterator of objects.
+
+    The file is read straight away, so it can be closed before the clippings
+    are consumed; the entries themselves are parsed lazily.
+    """
+
+    data = clippings_file.read()
+    return _parse_entries(_split_entries(data, CLIPPINGS_SEPARATOR))
+
+
+def parse_clippings_path(path):
+    """Parse the clippings file at path, and yield them as objects.
+
+    Same as parse_clippings, but regular files are memory-mapped and only the
+    individual entries are decoded, instead of reading it into one string.
+    Anything that can't be mapped (pipes, FIFOs, ...) is read in text mode.
+    """
+    with open(path, "rb") as clippings_file:
+        st = os.fstat(clippings_file.fileno())
+        data = None
+        if stat.S_ISREG(st.st_mode):
+            if st.st_size == 0:
+                return
+            try:
+                data = mmap.mmap(clippings_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass
+
+        if data is None:
+            text_file = io.TextIOWrapper(clippings_file, encoding="utf-8")
+            yield from parse_clippings(text_file)
+            return
+
+        with data:
+            entries = _split_entries(data, CLIPPINGS_SEPARATOR.encode())
+            yield from _parse_entries(_decode_entry(entry) for entry in entries)
 
 
 def as_dicts(clippings):
@@ -213,7 +316,7 @@ def group_clippings_by_book(clippings):
     """Group clippings by book title.
 
     Args:
-        clippings (list): List of clipping dictionaries
+        clippings (iterable): Clipping objects, e.g. from parse_clippings
 
     Returns:
         dict: Dictionary with book titles as keys and lists of clippings as values
@@ -225,13 +328,10 @@ def group_clippings_by_book(clippings):
             books[title] = {"author": clipping.document.authors, "clippings": []}
         books[title]["clippings"].append(clipping)
 
-    # Sort clippings by location
+    # Sort clippings by location; Location.parse always sets begin
+    location_begin = operator.attrgetter("metadata.location.begin")
     for book in books.values():
-        book["clippings"].sort(
-            key=lambda x: x.metadata.location.begin
-            if hasattr(x.metadata.location, "begin")
-            else 0
-        )
+        book["clippings"].sort(key=location_begin)
 
     return books
 
@@ -245,92 +345,97 @@ def group_clippings_by_book_dict(clippings_dict):
     Returns:
         dict: Dictionary with book titles as keys and lists of clippings as values
     """
-    books = {}
+    books = defaultdict(lambda: {"author": None, "clippings": []})
     for clipping in clippings_dict:
-        title = clipping["document"]["title"]
-        if title not in books:
-            books[title] = {"author": clipping["document"]["authors"], "clippings": []}
-        books[title]["clippings"].append(clipping)
+        document = clipping["document"]
+        book = books[document["title"]]
+        if book["author"] is None:
+            book["author"] = document["authors"]
+        book["clippings"].append(clipping)
 
-    # Sort clippings by location
+    # Sort clippings by location; begin is already an int from Location.parse
     for book in books.values():
-        book["clippings"].sort(
-            key=lambda x: int(x["metadata"]["location"]["begin"])
-            if "begin" in x["metadata"]["location"]
-            else 0
-        )
+        book["clippings"].sort(key=lambda x: x["metadata"]["location"]["begin"])
 
-    return books
+    return dict(books)
 
 
 def generate_markdown_output(books, output_file):
     """Generate markdown output from grouped clippings.
 
     Args:
-        books (dict): Dictionary of books with their clippings
+        books (dict): Dictionary of books with their Clipping objects
         output_file (str): Path to output file
     """
-    logger.info(f"Generating markdown output to: {output_file}")
+    logger.info("Generating markdown output to: %s", output_file)
 
     with open(output_file, "w", encoding="utf-8") as f:
-        f.write("# Kindle Clippings\n\n")
+        # Fragments are collected and written once per book
+        parts = ["# Kindle Clippings\n\n"]
 
         for title, book_info in books.items():
             author = book_info["author"]
             clippings = book_info["clippings"]
 
-            f.write(f"## {title}\n")
+            parts.append(f"## {title}\n")
             if author and author != "Unknown":
-                f.write(f"**Author:** {author}\n\n")
+                parts.append(f"**Author:** {author}\n\n")
 
             # Group clippings by type
-            highlights = [
-                c for c in clippings if c["metadata"]["category"] == "Highlight"
-            ]
+            highlights = [c for c in clippings if c.metadata.category == "Highlight"]
             # Only include highlights as requested
-            # notes = [c for c in clippings if c['metadata']['category'] == "Note"]
-            # bookmarks = [c for c in clippings if c['metadata']['category'] == "Bookmark"]
+            # notes = [c for c in clippings if c.metadata.category == "Note"]
+            # bookmarks = [c for c in clippings if c.metadata.category == "Bookmark"]
 
             if highlights:
-                f.write(f"### Highlights ({len(highlights)})\n\n")
+                parts.append(f"### Highlights ({len(highlights)})\n\n")
                 for i, highlight in enumerate(highlights, 1):
-                    f.write(f"{i}. {highlight['content']}\n")
-                    if highlight["metadata"]["location"]:
-                        f.write(
-                            f"   - Location: {highlight['metadata']['location']['begin']}-{highlight['metadata']['location']['end']}\n"
+                    parts.append(f"{i}. {highlight.content}\n")
+                    if highlight.metadata.location:
+                        parts.append(
+                            f"   - Location: {highlight.metadata.location.begin}-{highlight.metadata.location.end}\n"
                         )
-                    if highlight["metadata"]["page"]:
-                        f.write(f"   - Page: {highlight['metadata']['page']}\n")
-                    f.write("\n")
+                    if highlight.metadata.page:
+                        parts.append(f"   - Page: {highlight.metadata.page}\n")
+                    parts.append("\n")
 
             # Skip notes and bookmarks as requested
             # if notes:
-            #     f.write(f"### Notes ({len(notes)})\n\n")
+            #     parts.append(f"### Notes ({len(notes)})\n\n")
             #     for i, note in enumerate(notes, 1):
-            #         f.write(f"{i}. {note['content']}\n")
-            #         if note['metadata']['location']:
-            #             f.write(f"   - Location: {note['metadata']['location']['begin']}-{note['metadata']['location']['end']}\n")
-            #         if note['metadata']['page']:
-            #             f.write(f"   - Page: {note['metadata']['page']}\n")
-            #         f.write("\n")
+            #         parts.append(f"{i}. {note.content}\n")
+            #         if note.metadata.location:
+            #             parts.append(f"   - Location: {note.metadata.location.begin}-{note.metadata.location.end}\n")
+            #         if note.metadata.page:
+            #             parts.append(f"   - Page: {note.metadata.page}\n")
+            #         parts.append("\n")
 
             # if bookmarks:
-            #     f.write(f"### Bookmarks ({len(bookmarks)})\n\n")
+            #     parts.append(f"### Bookmarks ({len(bookmarks)})\n\n")
             #     for i, bookmark in enumerate(bookmarks, 1):
-            #         f.write(f"{i}. Bookmark\n")
-            #         if bookmark['metadata']['location']:
-            #             f.write(f"   - Location: {bookmark['metadata']['location']['begin']}-{bookmark['metadata']['location']['end']}\n")
-            #         if bookmark['metadata']['page']:
-            #             f.write(f"   - Page: {bookmark['metadata']['page']}\n")
-            #         f.write("\n")
+            #         parts.append(f"{i}. Bookmark\n")
+            #         if bookmark.metadata.location:
+            #             parts.append(f"   - Location: {bookmark.metadata.location.begin}-{bookmark.metadata.location.end}\n")
+            #         if bookmark.metadata.page:
+            #             parts.append(f"   - Page: {bookmark.metadata.page}\n")
+            #         parts.append("\n")
 
-            f.write("---\n\n")
+            parts.append("---\n\n")
+            f.write("".join(parts))
+            parts.clear()
+
+        f.write("".join(parts))
 
     logger.info("Markdown output generated successfully")
 
 
 def main():
     """Main function to parse clippings and generate output."""
+    # Configure logging
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+
     parser = argparse.ArgumentParser(
         description="Parse Kindle clippings file and generate markdown output"
     )
@@ -359,35 +464,33 @@ def main():
         input_file = os.path.join("input", os.path.basename(args.input_file))
 
     try:
-        logger.info(f"Parsing input file: {input_file}")
-        with open(input_file, "r", encoding="utf-8") as clippings_file:
-            clippings = parse_clippings(clippings_file)
+        logger.info("Parsing input file: %s", input_file)
+        # Clippings are grouped by book as they are parsed; the markdown is
+        # written from the objects
+        books = group_clippings_by_book(parse_clippings_path(input_file))
     except FileNotFoundError:
-        logger.error(f"File not found: {args.input_file}")
+        logger.error("File not found: %s", args.input_file)
         return
     except Exception as e:
-        logger.error(f"Error reading file: {e}")
+        logger.error("Error reading file: %s", e)
         return
 
-    if not clippings:
+    if not books:
         logger.warning("No clippings found in the file")
         return
 
-    # Convert to dictionaries for easier handling
-    clip_dicts = as_dicts(clippings)
-
-    # Group clippings by book using the dictionary format
-    books = group_clippings_by_book_dict(clip_dicts)
-
     # Generate markdown output
     generate_markdown_output(books, args.output)
 
-    # Optionally generate JSON output
+    # Optionally generate JSON output, the only place dictionaries are needed
     if args.json:
+        books = {
+            title: {"author": book["author"], "clippings": as_dicts(book["clippings"])}
+            for title, book in books.items()
+        }
         json_output = args.output.replace(".md", ".json")
-        logger.info(f"Generating JSON output to: {json_output}")
-        with open(json_output, "w", encoding="utf-8") as f:
-            json.dump(books, f, indent=2, cls=DatetimeJSONEncoder, ensure_ascii=False)
+        logger.info("Generating JSON output to: %s", json_output)
+        write_json(books, json_output)
         logger.info("JSON output generated successfully")
 
     logger.info("Processing completed successfully")
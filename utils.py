@@ -1,20 +1,64 @@
 """Various utilities not related to parsing per se."""
 
 import datetime
+import functools
 import json
 import re
 import dateutil.parser
 
+try:
+    import orjson
+except ImportError:  # Optional: fall back to the stdlib encoder
+    orjson = None
+
+# E.g. Friday, May 13, 2016 11:23:26 PM
+DATETIME_FORMAT = "%A, %B %d, %Y %I:%M:%S %p"
+
+_DAYS = frozenset(
+    ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+)
+_MONTHS = {
+    "January": 1,
+    "February": 2,
+    "March": 3,
+    "April": 4,
+    "May": 5,
+    "June": 6,
+    "July": 7,
+    "August": 8,
+    "September": 9,
+    "October": 10,
+    "November": 11,
+    "December": 12,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _slot_names(cls):
+    """Return the attribute slots of cls, including those of its bases."""
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(n for n in slots if n not in ("__dict__", "__weakref__"))
+    return tuple(names)
+
 
 class BasicEqualityMixin:
     """Mixin to facilitate implementing the equality operator
 
-    Subclasses of this will test for equality by checking the type, then
-    comparing the attributes dictionary.
+    Subclasses of this declare their attributes in __slots__, and will test
+    for equality by checking the type, then comparing the attribute values.
     """
 
+    __slots__ = ()
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in _slot_names(type(self)))
+
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
+        return isinstance(other, self.__class__) and self._values() == other._values()
 
 
 class DatetimeJSONEncoder(json.JSONEncoder):
@@ -30,12 +74,61 @@ class DatetimeJSONEncoder(json.JSONEncoder):
             return json.JSONEncoder.default(self, o)
 
 
+def write_json(obj, path):
+    """Write obj as indented UTF-8 JSON, encoding datetimes in ISO format.
+
+    Uses orjson when it is installed, DatetimeJSONEncoder otherwise; both
+    produce the same output.
+    """
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2, cls=DatetimeJSONEncoder, ensure_ascii=False)
+
+
 def clean_text(text):
     """Clean text by removing extra whitespace and normalizing."""
     # Remove leading/trailing whitespace and normalize internal whitespace
     return re.sub(r"\s+", " ", text.strip())
 
 
+def _parse_kindle_date(date_string):
+    """Parse a date string in exactly DATETIME_FORMAT, with English names.
+
+    Raises ValueError for anything else.
+    """
+    try:
+        day_name, rest = date_string.split(", ", 1)
+        month_name, rest = rest.split(" ", 1)
+        day, rest = rest.split(", ", 1)
+        year, rest = rest.split(" ", 1)
+        hms, ampm = rest.rsplit(" ", 1)
+        hour, minute, second = hms.split(":")
+        month = _MONTHS[month_name]
+    except KeyError:
+        raise ValueError(f"Unknown month: {date_string}") from None
+
+    hour = int(hour)
+    if day_name not in _DAYS or ampm not in ("AM", "PM") or not 1 <= hour <= 12:
+        raise ValueError(f"Not a Kindle timestamp: {date_string}")
+    hour = hour % 12 + (12 if ampm == "PM" else 0)
+    return datetime.datetime(int(year), month, int(day), hour, int(minute), int(second))
+
+
 def parse_date(date_string):
-    """Parse a date string into a datetime object."""
-    return dateutil.parser.parse(date_string)
+    """Parse a date string into a datetime object.
+
+    The Kindle format is tried first with a specialised parser, then with
+    strptime; dateutil is only used as a fallback for strings that don't
+    match it (e.g. localized month names).
+    """
+    try:
+        return _parse_kindle_date(date_string)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.strptime(date_string, DATETIME_FORMAT)
+    except ValueError:
+        return dateutil.parser.parse(date_string)